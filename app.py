@@ -1,13 +1,37 @@
+import atexit
 from datetime import timedelta
-from flask import Flask, render_template
+import threading
+from typing import Optional
+from flask import Flask, Response, render_template, request
 
 from database import Database
+from fetch import load_all_sources
+from heatmap import decode_matrix, get_heatmap
+from ingest import IngestBuffer, get_ingest_source
 from util import get_start_of_week, get_timeperiods
 
 DB_PATH = "./data.db"
 
 app = Flask(__name__)
 
+load_all_sources()
+
+_ingest_buffer: Optional[IngestBuffer] = None
+_ingest_buffer_lock = threading.Lock()
+
+
+def get_ingest_buffer() -> IngestBuffer:
+    """
+    The ingest buffer is created on the first ingest request, so processes that only import the app (like the
+    debug reloader's parent) never replay or lock the log.
+    """
+    global _ingest_buffer
+    with _ingest_buffer_lock:
+        if _ingest_buffer is None:
+            _ingest_buffer = IngestBuffer(durability="log")
+            atexit.register(_ingest_buffer.close)
+    return _ingest_buffer
+
 
 @app.route("/")
 def index():
@@ -31,6 +55,63 @@ def fetch():
     }
 
 
+@app.route("/api/heatmap/<source_id>/<int:year>", methods=["GET"])
+def heatmap(source_id: str, year: int):
+    """
+    Serves a year of a source's habit heatmap.
+
+    Default is columnar json ({category: [value per day]}). With ?format=binary, returns the raw matrices
+    concatenated in the order of the X-Heatmap-Categories header (uint32 seconds per day, or a bitmap).
+    Days are laid out on a 366 day calendar in every year: index 59 is Feb 29 and is empty in non-leap years.
+    """
+    with Database() as db:
+        kind, matrices = get_heatmap(db, source_id, year)
+
+    if kind is None:
+        return {"error": f"no heatmap for {source_id} in {year}"}, 404
+
+    if request.args.get("format") == "binary":
+        return Response(
+            b"".join(matrices.values()),
+            mimetype="application/octet-stream",
+            headers={
+                "X-Heatmap-Kind": kind,
+                "X-Heatmap-Categories": ",".join(matrices.keys()),
+            },
+        )
+
+    return {
+        "year": year,
+        "kind": kind,
+        "categories": list(matrices.keys()),
+        "values": {
+            category: decode_matrix(kind, matrix)
+            for category, matrix in matrices.items()
+        },
+    }
+
+
+@app.route("/api/ingest/<source_id>", methods=["POST"])
+def ingest(source_id: str):
+    """
+    Buffers one row (json object) or many (json array) for a push source. Rows are group committed, see ingest.py.
+    """
+    source = get_ingest_source(source_id)
+    if source is None:
+        return {"error": f"{source_id} doesn't accept ingest"}, 404
+
+    body = request.get_json(silent=True)
+    rows = body if isinstance(body, list) else [body]
+    try:
+        accepted = get_ingest_buffer().add(source, rows)
+    except ValueError as e:
+        return {"error": str(e)}, 400
+    except RuntimeError as e:
+        return {"error": str(e)}, 503
+
+    return {"accepted": accepted}
+
+
 # @app.route("/api/query", methods=["GET"])
 # def execute_sql():
 #     table = "computer_use"
@@ -56,6 +56,26 @@ class Database:
         )
         print(f"inserted {len(rows)} rows into {table} table")
 
+    def delete_rows_at(self, table: str, timestamps: List[datetime]):
+        """
+        Deletes all rows in a table whose timestamp is one of `timestamps`.
+        """
+        self.cursor.executemany(
+            f"DELETE FROM {table} WHERE timestamp = ?",
+            [(ts,) for ts in set(timestamps)],
+        )
+
+    def delete_rows_in_time_range(
+        self, table: str, start_time: datetime, end_time: datetime
+    ):
+        """
+        Deletes all rows in a table between start_time and end_time (inclusive).
+        """
+        self.cursor.execute(
+            f"DELETE FROM {table} WHERE timestamp BETWEEN ? AND ?",
+            (start_time.isoformat(), end_time.isoformat()),
+        )
+
     def get_rows_in_time_range(
         self,
         table: str,
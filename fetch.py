@@ -7,17 +7,36 @@ from datetime import datetime
 
 
 from database import Database
+from heatmap import heatmap_day, refresh_heatmap_days, update_heatmap
 from sources.registry import source_registry
 
 
 class Source(ABC):
     id: str
     schema: List[str]
+    # habit heatmap (see heatmap.py): None, "seconds" (sums duration per day) or "bitmap" (any row that day)
+    heatmap_kind: Optional[str] = None
+    heatmap_category_column: Optional[str] = None
+    # if True, fetched rows replace existing rows with the same timestamp (for sources that re-emit edited days)
+    replace_existing: bool = False
 
     @abstractmethod
     def fetch(cls, last_queried: Optional[datetime]) -> List[Dict]:
         pass
 
+    @classmethod
+    def replaced_timestamps(cls, rows: List[Dict]) -> List[datetime]:
+        "With replace_existing, existing rows at these timestamps are deleted before `rows` are inserted"
+        return [row["timestamp"] for row in rows]
+
+    @classmethod
+    def on_commit(cls):
+        """
+        Called once fetch_all has committed the rows from fetch. Sources that keep their own bookkeeping (what's
+        already been imported, etc.) should save it here, so a failed fetch_all doesn't skip anything next time.
+        """
+        pass
+
     @classmethod
     def register(cls):
         # print(f"Registering: {cls.__name__}")
@@ -38,6 +57,7 @@ def fetch_all():
     with open("./sources/last_queried.json", "rt") as f:
         last_queried = json.load(f)
 
+    fetched = []
     with Database() as db:
         for source in source_registry:
             source_last_fetched = (
@@ -52,12 +72,23 @@ def fetch_all():
                 )
             rows = source.fetch(last_queried=source_last_fetched)
             col_names = [s.split(" ")[0] for s in source.schema]
-            db.insert(source.id, columns=col_names, rows=rows)
+            if source.replace_existing:
+                timestamps = source.replaced_timestamps(rows)
+                db.delete_rows_at(source.id, timestamps)
+                db.insert(source.id, columns=col_names, rows=rows)
+                refresh_heatmap_days(db, source, map(heatmap_day, timestamps))
+            else:
+                db.insert(source.id, columns=col_names, rows=rows)
+                update_heatmap(db, source, rows)
+            fetched.append(source)
 
             print(f"[SOURCES] inserted {len(rows)} into {source.id} table")
 
             last_queried[source.id] = datetime.now().isoformat()
 
+    for source in fetched:
+        source.on_commit()
+
     with open("./sources/last_queried.json", "wt") as f:
         json.dump(last_queried, f)
 
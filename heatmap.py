@@ -0,0 +1,251 @@
+"""
+Habit heatmap
+
+Keeps a compact day x category matrix per source and year so the frontend can render a full year without
+running a UNION ALL branch per day through Database.query.
+
+Two kinds of matrices:
+- "seconds": dense array of unsigned 32-bit seconds per day (366 * 4 bytes per category)
+- "bitmap": one bit per day, set if there's any row that day (46 bytes per category)
+
+Days are local days starting at util.DAY_OFFSET, same as computer_use. Matrices are updated incrementally from
+fetch_all as rows are inserted. Run this file directly to rebuild them from the existing tables (e.g. after
+enabling the heatmap for a source that already has data).
+"""
+
+from array import array
+from collections import defaultdict
+from datetime import date, datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from database import Database
+from util import get_day
+
+HEATMAP_TABLE = "heatmap"
+# every year is laid out on a leap year calendar, so a given month and day always has the same index (Mar 1 is 60)
+# and Feb 29 (index 59) is just empty in non-leap years
+DAYS_PER_YEAR = 366
+_LEAP_YEAR = 2000
+BITMAP_BYTES = (DAYS_PER_YEAR + 7) // 8
+MAX_SECONDS = 0xFFFFFFFF
+
+KINDS = ("seconds", "bitmap")
+
+
+def create_heatmap_table(db: Database):
+    db.cursor.execute(f"""CREATE TABLE IF NOT EXISTS {HEATMAP_TABLE} (
+source TEXT,
+category TEXT,
+year INTEGER,
+kind TEXT,
+data BLOB,
+PRIMARY KEY (source, category, year)
+)""")
+
+
+def empty_matrix(kind: str) -> bytes:
+    if kind == "seconds":
+        return bytes(DAYS_PER_YEAR * 4)
+    elif kind == "bitmap":
+        return bytes(BITMAP_BYTES)
+    raise ValueError(f"Invalid heatmap kind: {kind}. Choose from {', '.join(KINDS)}.")
+
+
+def _to_seconds(duration) -> int:
+    "seconds as the timedelta adapter stores them, so fresh rows count the same as rows read back from the table"
+    if duration is None:
+        return 0
+    if isinstance(duration, timedelta):
+        return duration.seconds  # mirrors the adapter in database.py, which drops whole days
+    return int(duration)  # stored timedeltas come back as seconds
+
+
+def _to_datetime(timestamp) -> datetime:
+    if isinstance(timestamp, datetime):
+        return timestamp
+    return datetime.fromisoformat(timestamp)
+
+
+def heatmap_day(timestamp) -> date:
+    "The day a row's timestamp lands on in the heatmap"
+    return get_day(_to_datetime(timestamp))
+
+
+def _day_index(day: date) -> int:
+    return date(_LEAP_YEAR, day.month, day.day).timetuple().tm_yday - 1
+
+
+def _day_totals(source, rows: List[Dict]) -> Dict[Tuple[str, date], int]:
+    "Sums rows into seconds per (category, day), so rounding never happens per row"
+    category_column = getattr(source, "heatmap_category_column", None)
+    totals: Dict[Tuple[str, date], int] = defaultdict(int)
+    for row in rows:
+        category = row[category_column] if category_column else source.id
+        totals[(category, heatmap_day(row["timestamp"]))] += _to_seconds(
+            row.get("duration")
+        )
+    return totals
+
+
+def apply_totals(
+    kind: str,
+    matrix: bytes,
+    day_values: Iterable[Tuple[int, int]],
+    replace: bool = False,
+) -> bytes:
+    """
+    Folds (day_of_year_index, seconds) pairs into a matrix and returns the updated matrix.
+
+    :param kind: "seconds" or "bitmap"
+    :param matrix: Existing matrix bytes (see empty_matrix)
+    :param day_values: Pairs of 0-based day-of-year index and seconds. For bitmaps, any pair sets the day.
+    :param replace: Overwrite the days instead of adding to them
+    :return: Updated matrix bytes
+    """
+    if kind == "seconds":
+        seconds = array("I")
+        seconds.frombytes(matrix)
+        for day, value in day_values:
+            seconds[day] = min(MAX_SECONDS, value + (0 if replace else seconds[day]))
+        return seconds.tobytes()
+
+    bits = bytearray(matrix)
+    for day, value in day_values:
+        if replace and value is None:
+            bits[day >> 3] &= ~(1 << (day & 7)) & 0xFF
+        else:
+            bits[day >> 3] |= 1 << (day & 7)
+    return bytes(bits)
+
+
+def _load_matrices(
+    db: Database, source_id: str, year: int
+) -> Dict[str, bytes]:
+    db.cursor.execute(
+        f"SELECT category, data FROM {HEATMAP_TABLE} WHERE source = ? AND year = ?",
+        (source_id, year),
+    )
+    return {row["category"]: row["data"] for row in db.cursor.fetchall()}
+
+
+def _store_matrix(db: Database, source, category: str, year: int, matrix: bytes):
+    db.cursor.execute(
+        f"INSERT OR REPLACE INTO {HEATMAP_TABLE} (source, category, year, kind, data) VALUES (?, ?, ?, ?, ?)",
+        (source.id, category, year, source.heatmap_kind, matrix),
+    )
+
+
+def update_heatmap(db: Database, source, rows: List[Dict]):
+    """
+    Incrementally adds freshly inserted rows of a source to its heatmap matrices.
+
+    Sources opt in with the `heatmap_kind` class attribute, and can split the heatmap into categories
+    with `heatmap_category_column` (otherwise the source id is the only category).
+    """
+    kind = getattr(source, "heatmap_kind", None)
+    if kind is None or len(rows) == 0:
+        return
+
+    # group by the matrix each day lands in so every matrix is read and written once
+    grouped: Dict[Tuple[str, int], List[Tuple[int, int]]] = defaultdict(list)
+    for (category, day), seconds in _day_totals(source, rows).items():
+        grouped[(category, day.year)].append((_day_index(day), seconds))
+
+    create_heatmap_table(db)
+    for (category, year), day_values in grouped.items():
+        matrix = _load_matrices(db, source.id, year).get(category) or empty_matrix(kind)
+        _store_matrix(db, source, category, year, apply_totals(kind, matrix, day_values))
+
+
+def refresh_heatmap_days(db: Database, source, days: Iterable[date]):
+    """
+    Recomputes the given days of a source's heatmap, in every category, from the rows currently in its table.
+    Use this after deleting or rewriting rows.
+    """
+    kind = getattr(source, "heatmap_kind", None)
+    days: Set[date] = set(days)
+    if kind is None or len(days) == 0:
+        return
+
+    # timestamps are stored as isoformat strings, so bounding by date prefix works whatever their timezone. pad a
+    # day either side for timezones and the day offset, then filter exactly in python
+    db.cursor.execute(
+        f"SELECT * FROM {source.id} WHERE timestamp >= ? AND timestamp < ?",
+        (
+            (min(days) - timedelta(days=1)).isoformat(),
+            (max(days) + timedelta(days=2)).isoformat(),
+        ),
+    )
+    rows = [
+        row
+        for row in map(dict, db.cursor.fetchall())
+        if heatmap_day(row["timestamp"]) in days
+    ]
+    totals = _day_totals(source, rows)
+
+    create_heatmap_table(db)
+    for year in {day.year for day in days}:
+        matrices = _load_matrices(db, source.id, year)
+        categories = set(matrices.keys()) | {c for c, d in totals if d.year == year}
+        for category in categories:
+            day_values = [
+                (_day_index(day), totals.get((category, day), 0 if kind == "seconds" else None))
+                for day in days
+                if day.year == year
+            ]
+            matrix = matrices.get(category) or empty_matrix(kind)
+            _store_matrix(
+                db, source, category, year, apply_totals(kind, matrix, day_values, replace=True)
+            )
+
+
+def rebuild_heatmap(db: Database, source):
+    """
+    Drops and recomputes a source's heatmap matrices from every row in its table.
+    """
+    create_heatmap_table(db)
+    db.cursor.execute(f"DELETE FROM {HEATMAP_TABLE} WHERE source = ?", (source.id,))
+    db.cursor.execute(f"SELECT * FROM {source.id}")
+    rows = [dict(row) for row in db.cursor.fetchall()]
+    update_heatmap(db, source, rows)
+
+
+def get_heatmap(
+    db: Database, source_id: str, year: int
+) -> Tuple[Optional[str], Dict[str, bytes]]:
+    """
+    Returns the matrix kind and a {category: matrix bytes} dict for one source and year.
+    Kind is None if the source has no heatmap data for that year.
+    """
+    create_heatmap_table(db)
+    db.cursor.execute(
+        f"SELECT category, kind, data FROM {HEATMAP_TABLE} WHERE source = ? AND year = ? ORDER BY category",
+        (source_id, year),
+    )
+    kind = None
+    matrices = {}
+    for row in db.cursor.fetchall():
+        kind = row["kind"]
+        matrices[row["category"]] = row["data"]
+    return kind, matrices
+
+
+def decode_matrix(kind: str, matrix: bytes) -> List[int]:
+    "Expands a matrix into one int per day (seconds, or 0/1 for bitmaps)"
+    if kind == "seconds":
+        seconds = array("I")
+        seconds.frombytes(matrix)
+        return seconds.tolist()
+    return [(matrix[day >> 3] >> (day & 7)) & 1 for day in range(DAYS_PER_YEAR)]
+
+
+if __name__ == "__main__":
+    from fetch import load_all_sources
+    from sources.registry import source_registry
+
+    load_all_sources()
+    with Database() as db:
+        for source in source_registry:
+            if getattr(source, "heatmap_kind", None) is not None:
+                rebuild_heatmap(db, source)
+                print(f"[HEATMAP] rebuilt heatmap for {source.id}")
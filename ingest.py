@@ -0,0 +1,474 @@
+"""
+Push ingest with group commit
+
+fetch_all pulls from sources in batches, but some sources (randomized pings, etc.) push small events one at a
+time. Committing each event in its own sqlite transaction means an fsync per event, so events go through an
+IngestBuffer instead: rows are validated against the source's schema, buffered, and flushed to the database in a
+single transaction once `max_rows` are waiting or the oldest has waited `max_delay` seconds.
+
+Durability (when add() returns):
+- "memory": as soon as rows are buffered. Fastest, loses up to a flush worth of events on a crash.
+- "log": after rows are appended (and fsynced) to an append-only log, which is replayed on startup. Concurrent
+  writers share one fsync. Only one process can use a log path at a time.
+- "commit": after the transaction holding the rows commits. Concurrent writers share one commit.
+
+Sources opt in with `accepts_ingest = True`. app.py exposes POST /api/ingest/<source>, and running this file
+serves the same thing on a unix socket (newline-delimited json, see IngestRequestHandler).
+"""
+
+from collections import defaultdict, deque
+from datetime import datetime, timedelta
+from contextlib import suppress
+import fcntl
+import glob
+import json
+import math
+import os
+import socketserver
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+from database import Database
+from heatmap import update_heatmap
+from sources.registry import source_registry
+
+DB_PATH = "./store.db"
+LOG_PATH = "./ingest.log"
+SOCKET_PATH = "/tmp/dashboard_ingest.sock"
+
+DURABILITY_MODES = ("memory", "log", "commit")
+
+
+def _parse_column(column_type: str, value):
+    column_type = column_type.lower()
+    if isinstance(value, float) and not math.isfinite(value):
+        raise ValueError(f"expected a finite number, got {value!r}")
+    if column_type == "timestamp":
+        return value if isinstance(value, datetime) else datetime.fromisoformat(value)
+    elif column_type == "timedelta":
+        return value if isinstance(value, timedelta) else timedelta(seconds=float(value))
+    elif column_type == "text":
+        if not isinstance(value, str):
+            raise ValueError(f"expected a string, got {value!r}")
+        return value
+    elif column_type == "float":
+        return float(value)
+    elif column_type == "integer":
+        if isinstance(value, bool) or float(value) != int(value):
+            raise ValueError(f"expected an integer, got {value!r}")
+        return int(value)
+    raise ValueError(f"{column_type} columns can't be ingested")
+
+
+def validate_row(source, row: Dict) -> Dict:
+    """
+    Checks a row against a source's schema and converts json values to the column types.
+    Missing columns are None, except timestamp which defaults to now.
+
+    :raises ValueError: on unknown columns or values that don't match their column type
+    """
+    if not isinstance(row, dict):
+        raise ValueError(f"expected an object, got {row!r}")
+
+    column_types = dict(col.split(" ") for col in source.schema)
+    unknown = set(row.keys()) - set(column_types.keys())
+    if unknown:
+        raise ValueError(f"unknown columns for {source.id}: {', '.join(sorted(unknown))}")
+
+    validated = {}
+    for column, column_type in column_types.items():
+        value = row.get(column)
+        if value is None:
+            validated[column] = datetime.now() if column == "timestamp" else None
+            continue
+        try:
+            validated[column] = _parse_column(column_type, value)
+        except (TypeError, ValueError, OverflowError) as e:
+            raise ValueError(f"invalid value for {source.id}.{column}: {e}")
+    return validated
+
+
+def _to_json_value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    elif isinstance(value, timedelta):
+        return value.total_seconds()
+    return value
+
+
+def get_ingest_source(source_id: str):
+    "Returns the registered source that accepts ingest with the given id, or None"
+    for source in source_registry:
+        if source.id == source_id and getattr(source, "accepts_ingest", False):
+            return source
+    return None
+
+
+class IngestBuffer:
+    def __init__(
+        self,
+        db_path: str = DB_PATH,
+        durability: str = "log",
+        max_rows: int = 500,
+        max_delay: float = 1.0,
+        log_path: str = LOG_PATH,
+    ):
+        """
+        :param db_path: Database to flush into
+        :param durability: "memory", "log" or "commit", see module docstring
+        :param max_rows: Flush as soon as this many rows are buffered
+        :param max_delay: Flush once the oldest buffered row is this many seconds old
+        :param log_path: Append-only log for "log" durability
+        :raises RuntimeError: if another process is using log_path
+
+        Replays leftover logs and starts the flusher thread, so create buffers when they're first needed rather
+        than at import time.
+        """
+        if durability not in DURABILITY_MODES:
+            raise ValueError(
+                f"Invalid durability: {durability}. Choose from {', '.join(DURABILITY_MODES)}."
+            )
+        self.db_path = db_path
+        self.durability = durability
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self.log_path = log_path
+
+        self.rows: List[Tuple[object, Dict]] = []
+        self.oldest: Optional[float] = None
+        self.cond = threading.Condition()
+        self.closed = False
+
+        # "commit" durability: writers wait until the flush generation holding their rows commits
+        self.started_generation = 0
+        self.committed_generation = 0
+        self.close_failed = False  # the final flush in close() failed, so waiting writers raise instead
+
+        self.commit_latencies: deque = deque(maxlen=1000)
+
+        # "log" durability: writers append under cond, then one of them fsyncs for everyone waiting (sync_lock is
+        # always taken before cond)
+        self.log = None
+        self.log_lock = None
+        self.sync_lock = threading.Lock()
+        self.log_written = 0
+        self.log_synced = 0
+        self.log_syncs = 0
+        self.pending_logs: List[str] = []
+        if durability == "log":
+            self._lock_log()
+            self._replay_logs()
+            self.log = open(log_path, "at", encoding="utf-8")
+
+        self.flusher = threading.Thread(target=self._flush_loop, daemon=True)
+        self.flusher.start()
+
+    def add(self, source, rows: List[Dict]) -> int:
+        """
+        Validates and buffers rows for a source, returning once they're as durable as configured.
+
+        :raises ValueError: if any row is invalid, in which case none are buffered
+        :raises RuntimeError: if the buffer is closed, or with "commit" durability, if it closed without
+            committing the rows
+        """
+        validated = [validate_row(source, row) for row in rows]
+        if len(validated) == 0:
+            return 0
+
+        with self.cond:
+            if self.closed:
+                raise RuntimeError("ingest buffer is closed")
+
+            if self.log is not None:
+                for row in validated:
+                    entry = {
+                        "source": source.id,
+                        "row": {k: _to_json_value(v) for k, v in row.items()},
+                    }
+                    self.log.write(json.dumps(entry) + "\n")
+                self.log.flush()
+                self.log_written += 1
+                log_sequence = self.log_written
+
+            was_empty = self.oldest is None
+            if was_empty:
+                self.oldest = time.monotonic()
+            self.rows.extend((source, row) for row in validated)
+            generation = self.started_generation + 1
+            # wake the flusher to start its max_delay timer, flush a full buffer, or commit for waiting writers
+            if was_empty or len(self.rows) >= self.max_rows or self.durability == "commit":
+                self.cond.notify_all()
+
+            if self.durability == "commit":
+                while self.committed_generation < generation:
+                    if self.close_failed:
+                        raise RuntimeError("ingest buffer closed before the rows could be committed")
+                    self.cond.wait()
+
+        if self.durability == "log":
+            self._sync_log(log_sequence)
+
+        return len(validated)
+
+    def _sync_log(self, sequence: int):
+        "Returns once the log is fsynced past `sequence`. Writers that queue up during an fsync share the next one"
+        with self.sync_lock:
+            if self.log_synced >= sequence:
+                return
+            with self.cond:
+                target = self.log_written
+                fd = self.log.fileno()  # stays open, rotating the log needs sync_lock
+            os.fsync(fd)
+            self.log_synced = target
+            self.log_syncs += 1
+
+    def flush(self) -> bool:
+        "Commits everything buffered so far in one transaction. Returns False if the commit failed"
+        with self.sync_lock, self.cond:
+            batch = self.rows
+            self.rows = []
+            self.oldest = None
+            self.started_generation += 1
+            generation = self.started_generation
+            flushed_logs = self._rotate_log()
+
+        if len(batch) > 0:
+            start = time.perf_counter()
+            try:
+                self._commit(batch)
+            except Exception as e:
+                print(f"[INGEST] commit of {len(batch)} rows failed, will retry: {e}")
+                with self.cond:
+                    self.rows = batch + self.rows
+                    self.oldest = self.oldest or time.monotonic()
+                    self.pending_logs = flushed_logs + self.pending_logs
+                return False
+            self.commit_latencies.append(time.perf_counter() - start)
+
+        for path in flushed_logs:
+            with suppress(FileNotFoundError):
+                os.remove(path)
+
+        with self.cond:
+            self.committed_generation = generation
+            self.cond.notify_all()
+        return True
+
+    def close(self):
+        "Stops the flusher and flushes remaining rows. Writers waiting on a commit stay blocked until that's done"
+        with self.cond:
+            if self.closed:
+                return
+            self.closed = True
+            self.cond.notify_all()
+        self.flusher.join()
+        if not self.flush():
+            with self.cond:
+                self.close_failed = True
+                self.cond.notify_all()
+        if self.log is not None:
+            self.log.close()
+            if os.path.getsize(self.log_path) == 0:
+                os.remove(self.log_path)
+            self.log_lock.close()  # releases the flock
+
+    def _commit(self, batch: List[Tuple[object, Dict]]):
+        by_source: Dict[object, List[Dict]] = defaultdict(list)
+        for source, row in batch:
+            by_source[source].append(row)
+
+        with Database(self.db_path) as db:
+            for source, rows in by_source.items():
+                db.create_table(source.id, source.schema)
+                col_names = [s.split(" ")[0] for s in source.schema]
+                db.insert(source.id, columns=col_names, rows=rows)
+                update_heatmap(db, source, rows)
+
+    def _flush_loop(self):
+        while True:
+            with self.cond:
+                while not self.closed:
+                    if len(self.rows) >= self.max_rows:
+                        break
+                    # writers are blocked on the commit, so don't make them wait for more to arrive. rows added
+                    # while a commit is in flight still share the next one
+                    if self.durability == "commit" and len(self.rows) > 0:
+                        break
+                    if self.oldest is not None:
+                        remaining = self.oldest + self.max_delay - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        self.cond.wait(remaining)
+                    else:
+                        self.cond.wait()
+                if self.closed:
+                    return
+            try:
+                flushed = self.flush()
+            except Exception as e:
+                print(f"[INGEST] flush failed, will retry: {e}")
+                flushed = False
+            if not flushed:
+                time.sleep(self.max_delay)  # don't spin on a database that keeps failing
+
+    def _rotate_log(self) -> List[str]:
+        """
+        Must hold self.sync_lock and self.cond. Moves the current log aside so it can be deleted once its rows
+        commit, and returns every log waiting on this flush.
+        """
+        if self.log is not None and self.log.tell() > 0:
+            # writers still waiting on an fsync of this file won't get one from the next log
+            os.fsync(self.log.fileno())
+            self.log_synced = self.log_written
+            self.log_syncs += 1
+            self.log.close()
+            rotated = f"{self.log_path}.{time.time_ns()}"
+            os.rename(self.log_path, rotated)
+            self.pending_logs.append(rotated)
+            self.log = open(self.log_path, "at", encoding="utf-8")
+        flushed_logs = self.pending_logs
+        self.pending_logs = []
+        return flushed_logs
+
+    def _lock_log(self):
+        self.log_lock = open(f"{self.log_path}.lock", "w")
+        try:
+            fcntl.flock(self.log_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self.log_lock.close()
+            raise RuntimeError(
+                f"{self.log_path} is in use by another ingest process, give this one its own log_path"
+            )
+
+    def _replay_logs(self):
+        "Buffers rows from logs left behind by a previous process"
+        paths = sorted(
+            path
+            for path in glob.glob(f"{glob.escape(self.log_path)}.*")
+            if path.rsplit(".", 1)[-1].isdigit()  # rotated logs, not the lock
+        )
+        if os.path.exists(self.log_path):
+            rotated = f"{self.log_path}.{time.time_ns()}"
+            os.rename(self.log_path, rotated)
+            paths.append(rotated)
+
+        for path in paths:
+            with open(path, "rt", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # torn write at the end of the log
+                    source = get_ingest_source(entry["source"])
+                    if source is None:
+                        print(f"[INGEST] dropping logged row for unknown source {entry['source']}")
+                        continue
+                    self.rows.append((source, validate_row(source, entry["row"])))
+            self.pending_logs.append(path)
+
+        if len(self.rows) > 0:
+            print(f"[INGEST] replayed {len(self.rows)} rows from {len(paths)} logs")
+            self.oldest = time.monotonic() - self.max_delay
+
+
+class IngestRequestHandler(socketserver.StreamRequestHandler):
+    """
+    One json object per line, either {"source": id, "rows": [...]} or {"source": id, <columns>}.
+    Replies one line per request, "ok <count>" or "error <message>".
+    """
+
+    buffer: IngestBuffer
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                if not isinstance(request, dict):
+                    raise ValueError(f"expected a json object, got {request!r}")
+                source = get_ingest_source(request.pop("source", None))
+                if source is None:
+                    raise ValueError("unknown source")
+                rows = request["rows"] if "rows" in request else [request]
+                reply = f"ok {self.buffer.add(source, rows)}"
+            except (ValueError, KeyError, TypeError, RuntimeError) as e:
+                reply = f"error {e}"
+            self.wfile.write((reply + "\n").encode())
+
+
+def serve_unix_socket(buffer: IngestBuffer, socket_path: str = SOCKET_PATH):
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    IngestRequestHandler.buffer = buffer
+    with socketserver.ThreadingUnixStreamServer(socket_path, IngestRequestHandler) as server:
+        print(f"[INGEST] listening on {socket_path}")
+        try:
+            server.serve_forever()
+        finally:
+            buffer.close()
+            os.remove(socket_path)
+
+
+def benchmark(n_events: int = 2000, n_writers: int = 16):
+    "Compares a transaction per event against group commit in each durability mode"
+    from concurrent.futures import ThreadPoolExecutor
+    import statistics
+    import tempfile
+
+    from sources.ping import PingSource
+
+    def event(i: int) -> Dict:
+        return {"mood": i % 10, "energy": i % 7, "focus": i % 5}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "bench.db")
+
+        n_naive = min(n_events, 200)
+        start = time.perf_counter()
+        for i in range(n_naive):
+            with Database(db_path) as db:
+                db.create_table(PingSource.id, PingSource.schema)
+                col_names = [s.split(" ")[0] for s in PingSource.schema]
+                db.insert(PingSource.id, columns=col_names, rows=[validate_row(PingSource, event(i))])
+        elapsed = time.perf_counter() - start
+        results = [f"transaction per event: {n_naive / elapsed:,.0f} events/s"]
+
+        for durability in DURABILITY_MODES:
+            buffer = IngestBuffer(
+                db_path=db_path,
+                durability=durability,
+                log_path=os.path.join(tmp, f"{durability}.log"),
+            )
+            start = time.perf_counter()
+            with ThreadPoolExecutor(n_writers) as pool:
+                list(pool.map(lambda i: buffer.add(PingSource, [event(i)]), range(n_events)))
+            buffer.close()
+            elapsed = time.perf_counter() - start
+
+            latencies = sorted(buffer.commit_latencies)
+            syncs = f", {buffer.log_syncs} log fsyncs" if durability == "log" else ""
+            results.append(
+                f"group commit ({durability}): {n_events / elapsed:,.0f} events/s, "
+                f"{len(latencies)} commits, median {statistics.median(latencies) * 1000:.1f} ms, "
+                f"max {latencies[-1] * 1000:.1f} ms{syncs}"
+            )
+
+    print("\n".join(results))
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from fetch import load_all_sources
+
+    parser = argparse.ArgumentParser(description="serve ingest on a unix socket")
+    parser.add_argument("--socket", default=SOCKET_PATH)
+    parser.add_argument("--durability", default="log", choices=DURABILITY_MODES)
+    parser.add_argument("--bench", type=int, metavar="N_EVENTS", help="run the benchmark instead")
+    args = parser.parse_args()
+
+    load_all_sources()
+    if args.bench:
+        benchmark(args.bench)
+    else:
+        serve_unix_socket(IngestBuffer(durability=args.durability), args.socket)
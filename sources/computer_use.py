@@ -4,14 +4,24 @@ source for activity watch
 Uses aw-client (https://github.com/ActivityWatch/aw-client)
 
 Heavily inspired by this example: https://github.com/ActivityWatch/aw-client/blob/master/examples/working_hours.py
+
+Raw window events are kept in activitywatch_raw.db and categorized locally, so changing CATEGORY_REGEXES doesn't
+need ActivityWatch:
+- `python -m sources.computer_use --backfill` loads the full raw history from ActivityWatch into the raw store, once,
+  without touching the merged rows. Recategorizing only reaches events the raw store has, so run this first.
+- `python -m sources.computer_use --recategorize` re-categorizes the raw events and rebuilds the merged rows of the
+  days that changed. fetch also does this (after fetch_all commits) when it notices the regexes changed.
 """
 
 from dataclasses import asdict, dataclass
+import hashlib
 import json
 import logging
 import os
+import re
 import socket
-from datetime import date, datetime, time, timedelta
+import time as tm
+from datetime import date, datetime, time, timedelta, timezone
 from typing import Dict, List, Optional, Tuple
 
 import aw_client
@@ -21,12 +31,15 @@ from aw_transform import flood
 
 from database import Database
 from fetch import Source
+from heatmap import heatmap_day, refresh_heatmap_days
+from util import DAY_OFFSET
 
 
 OUTPUT_HTML = os.environ.get("OUTPUT_HTML", "").lower() == "true"
+RAW_DB_PATH = "./activitywatch_raw.db"
 
 td1d = timedelta(days=1)
-day_offset = timedelta(hours=4)
+day_offset = DAY_OFFSET
 
 # NOTE: we ignore case for all
 CATEGORY_REGEXES = {
@@ -57,52 +70,41 @@ def join_close_events(events: List[dict], max_break: float) -> List[JoinedEvent]
     events_e: List[Event] = [Event(**e) for e in events]
     events_e = flood(events_e, max_break)
 
+    def merge(events_to_join: List[Event]) -> JoinedEvent:
+        return JoinedEvent(
+            timestamp=events_to_join[0]["timestamp"],
+            duration=sum(map(lambda e: e["duration"], events_to_join), timedelta()),
+            category=events_to_join[0]["data"]["$category"][0],
+        )
+
     joined_events = []
     events_to_join = []
     prev_end: datetime = None
     for event in events_e:
-        if len(events_to_join) == 0 or prev_end == event["timestamp"]:
-            events_to_join.append(event)
-        else:
-            # merge events and add to joined_events
-            joined_events.append(
-                JoinedEvent(
-                    timestamp=events_to_join[0]["timestamp"],
-                    duration=sum(
-                        map(lambda e: e["duration"], events_to_join), timedelta()
-                    ),
-                    category=events_to_join[0]["data"]["$category"][0],
-                )
-            )
-
-            # get ready for next super event
+        if len(events_to_join) > 0 and prev_end != event["timestamp"]:
+            # gap, so merge what we have and start the next super event with this one
+            joined_events.append(merge(events_to_join))
             events_to_join = []
+        events_to_join.append(event)
         prev_end = event["timestamp"] + event["duration"]
 
+    if len(events_to_join) > 0:
+        joined_events.append(merge(events_to_join))
+
     return joined_events
 
 
 def query(timeperiods: List[List[date]], hostname: str):
-    categories: List[Tuple[List[str], Dict]] = [
-        (
-            [category],
-            {
-                "type": "regex",
-                "regex": regex,
-                "ignore_case": True,
-            },
-        )
-        for category, regex in CATEGORY_REGEXES.items()
-    ]
-
+    """
+    Fetch uncategorized, AFK-filtered window events. Categorizing happens locally (see Classifier) so the raw events
+    can be stored and re-categorized without going back to ActivityWatch.
+    """
     aw = aw_client.ActivityWatchClient(client_name="data_aggregator")
 
     canonicalQuery = queries.canonicalEvents(
         queries.DesktopQueryParams(
             bid_window=f"aw-watcher-window_{hostname}",
             bid_afk=f"aw-watcher-afk_{hostname}",
-            classes=categories,
-            filter_classes=[[cat] for cat in CATEGORY_REGEXES.keys()],
         )
     )
     query = f"""
@@ -116,35 +118,371 @@ def query(timeperiods: List[List[date]], hostname: str):
     return res
 
 
+class Classifier:
+    """
+    Local version of ActivityWatch's regex categorization: a pattern matches if it's found in the app or the title,
+    and when several categories match the last one wins. Patterns are compiled once, and results are memoized per
+    distinct (app, title) pair since titles repeat heavily.
+    """
+
+    def __init__(self, category_regexes: Optional[Dict[str, str]] = None):
+        self.patterns = [
+            (category, re.compile(regex, re.IGNORECASE | re.UNICODE))
+            for category, regex in (category_regexes or CATEGORY_REGEXES).items()
+        ]
+        self.memo: Dict[Tuple[str, str], Optional[str]] = {}
+
+    def classify(self, app: str, title: str) -> Optional[str]:
+        key = (app, title)
+        if key not in self.memo:
+            category = None
+            for cat, pattern in self.patterns:
+                if pattern.search(app) or pattern.search(title):
+                    category = cat
+            self.memo[key] = category
+        return self.memo[key]
+
+
+def regexes_fingerprint() -> str:
+    return hashlib.sha256(json.dumps(CATEGORY_REGEXES).encode()).hexdigest()
+
+
+class RawEventStore:
+    """
+    Raw window events, kept in their own sqlite file (fetch_all holds the main store open during fetch).
+
+    Apps and titles are dictionary-encoded into `strings`, so an event is a timestamp, a duration and two ints.
+    `pairs` holds the current category of every distinct (app, title), which is what re-categorizing diffs against.
+    """
+
+    def __init__(self, db: Database):
+        self.db = db
+        self.db.cursor.execute("""CREATE TABLE IF NOT EXISTS strings (
+id INTEGER PRIMARY KEY,
+value TEXT UNIQUE
+)""")
+        self.db.create_table(
+            "events",
+            ["timestamp timestamp", "duration FLOAT", "app INTEGER", "title INTEGER"],
+        )
+        # re-fetching a window (e.g. after fetch_all rolled back) must not store its events twice
+        self.db.cursor.execute(
+            "CREATE UNIQUE INDEX IF NOT EXISTS events_unique ON events (timestamp, app, title)"
+        )
+        self.db.cursor.execute("""CREATE TABLE IF NOT EXISTS pairs (
+app INTEGER,
+title INTEGER,
+category TEXT,
+PRIMARY KEY (app, title)
+)""")
+        self.db.cursor.execute(
+            "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)"
+        )
+
+        self.db.cursor.execute("SELECT value, id FROM strings")
+        self.string_ids: Dict[str, int] = dict(self.db.cursor.fetchall())
+
+    def _string_id(self, value: str) -> int:
+        if value not in self.string_ids:
+            self.db.cursor.execute("INSERT INTO strings (value) VALUES (?)", (value,))
+            self.string_ids[value] = self.db.cursor.lastrowid
+        return self.string_ids[value]
+
+    def get_meta(self, key: str) -> Optional[str]:
+        self.db.cursor.execute("SELECT value FROM meta WHERE key = ?", (key,))
+        row = self.db.cursor.fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key: str, value: str):
+        self.db.cursor.execute(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value)
+        )
+
+    def insert_events(self, events: List[dict], classifier: Classifier):
+        """
+        Stores raw events from the ActivityWatch query, categorizing any (app, title) pairs not seen before
+        """
+        rows = []
+        new_pairs = {}
+        for e in events:
+            app = e["data"].get("app", "")
+            title = e["data"].get("title", "")
+            pair = (self._string_id(app), self._string_id(title))
+            rows.append(
+                (
+                    datetime.fromisoformat(e["timestamp"]).astimezone(timezone.utc),
+                    e["duration"],
+                    *pair,
+                )
+            )
+            if pair not in new_pairs:
+                new_pairs[pair] = classifier.classify(app, title)
+
+        self.db.cursor.executemany(
+            "INSERT OR IGNORE INTO events (timestamp, duration, app, title) VALUES (?, ?, ?, ?)",
+            rows,
+        )
+        self.db.cursor.executemany(
+            "INSERT OR IGNORE INTO pairs (app, title, category) VALUES (?, ?, ?)",
+            [(app, title, category) for (app, title), category in new_pairs.items()],
+        )
+
+    def recategorize_pairs(self, classifier: Classifier) -> List[Tuple[int, int]]:
+        """
+        Re-classifies every distinct (app, title) pair and returns the ones whose category changed
+        """
+        self.db.cursor.execute("""
+            SELECT pairs.app, pairs.title, pairs.category, a.value, t.value
+            FROM pairs
+            JOIN strings a ON a.id = pairs.app
+            JOIN strings t ON t.id = pairs.title
+        """)
+        changed = []
+        for app_id, title_id, old_category, app, title in self.db.cursor.fetchall():
+            category = classifier.classify(app, title)
+            if category != old_category:
+                changed.append((app_id, title_id, category))
+
+        self.db.cursor.executemany(
+            "UPDATE pairs SET category = ? WHERE app = ? AND title = ?",
+            [(category, app_id, title_id) for app_id, title_id, category in changed],
+        )
+        return [(app_id, title_id) for app_id, title_id, _ in changed]
+
+    def timestamps_of_pairs(self, pairs: List[Tuple[int, int]]) -> List[datetime]:
+        self.db.cursor.execute(
+            "CREATE TEMP TABLE IF NOT EXISTS changed_pairs (app INTEGER, title INTEGER)"
+        )
+        self.db.cursor.execute("DELETE FROM changed_pairs")
+        self.db.cursor.executemany("INSERT INTO changed_pairs VALUES (?, ?)", pairs)
+        self.db.cursor.execute("""
+            SELECT DISTINCT events.timestamp
+            FROM events
+            JOIN changed_pairs USING (app, title)
+        """)
+        return [row[0] for row in self.db.cursor.fetchall()]
+
+    def categorized_events(self, start: datetime, end: datetime) -> List[dict]:
+        """
+        Categorized events between start and end (inclusive), in the shape join_close_events expects
+        """
+        self.db.cursor.execute(
+            """
+            SELECT events.timestamp, events.duration, pairs.category
+            FROM events
+            JOIN pairs USING (app, title)
+            WHERE pairs.category IS NOT NULL AND events.timestamp BETWEEN ? AND ?
+            ORDER BY events.timestamp
+            """,
+            (start, end),
+        )
+        return [
+            {
+                "timestamp": ts,
+                "duration": timedelta(seconds=duration),
+                "data": {"$category": [category]},
+            }
+            for ts, duration, category in self.db.cursor.fetchall()
+        ]
+
+
+def merge_events(events: List[dict]) -> List[JoinedEvent]:
+    "flood to join close segments for each category"
+    joined_events: List[JoinedEvent] = []
+    for category in CATEGORY_REGEXES.keys():
+        category_events = [e for e in events if category in e["data"]["$category"]]
+        res = join_close_events(category_events, max_break=300)
+        joined_events.extend(res)
+    return joined_events
+
+
+def _day_start(ts: datetime) -> datetime:
+    "start of the (day_offset shifted) local day containing ts, in UTC"
+    local = ts.astimezone()
+    day = (local - day_offset).date()
+    return (datetime.combine(day, time()) + day_offset).astimezone(timezone.utc)
+
+
 class ComputerUseSource(Source):
     id = "computer_use"
     schema = ["timestamp timestamp", "duration timedelta", "category TEXT"]
+    heatmap_kind = "seconds"
+    heatmap_category_column = "category"
+
+    # set by fetch when CATEGORY_REGEXES changed: the fetched window, rebuilt by recategorize in on_commit
+    _pending_window: Optional[Tuple[datetime, datetime]] = None
 
     @classmethod
     def fetch(cls, last_queried: Optional[datetime]) -> List[Dict]:
         """
-        Fetch from last fetched timestamp until now, flood events up to max_break, and insert into database
+        Fetch from last fetched timestamp until now, store the raw events, categorize them locally, flood events up to
+        max_break, and return the merged rows.
+
+        If CATEGORY_REGEXES changed since the last fetch, known (app, title) pairs still have their old categories, so
+        only the raw events are stored and on_commit recategorizes history and this window together.
         """
+        cls._pending_window = None
         hostname = socket.gethostname()
 
         if last_queried is not None:
-            fetch_start = last_queried
+            fetch_start = last_queried.astimezone()
         else:
             fetch_start = (
                 datetime.combine(date(2020, 7, 15), time()) + day_offset
             ).astimezone()
         fetch_end = datetime.now().astimezone()
 
-        # fetch raw events from API and classify with regex
+        # fetch raw events from API
         raw_events = query([[fetch_start, fetch_end]], hostname)[0]["events"]
 
-        # flood to join close segments for each category
-        joined_events: List[JoinedEvent] = []
-        for category in CATEGORY_REGEXES.keys():
-            category_events = [
-                e for e in raw_events if category in e["data"]["$category"]
-            ]
-            res = join_close_events(category_events, max_break=300)
-            joined_events.extend(res)
+        with Database(RAW_DB_PATH) as raw_db:
+            store = RawEventStore(raw_db)
+            store.insert_events(raw_events, Classifier())
+
+            fingerprint = regexes_fingerprint()
+            if store.get_meta("regexes") not in (None, fingerprint):
+                print(
+                    "[COMPUTER_USE] CATEGORY_REGEXES changed since the last fetch, "
+                    "recategorizing once fetch_all commits"
+                )
+                cls._pending_window = (
+                    fetch_start.astimezone(timezone.utc),
+                    fetch_end.astimezone(timezone.utc),
+                )
+                return []
+
+            store.set_meta("regexes", fingerprint)
+            events = store.categorized_events(
+                fetch_start.astimezone(timezone.utc), fetch_end.astimezone(timezone.utc)
+            )
+
+        return [asdict(je) for je in merge_events(events)]
+
+    @classmethod
+    def on_commit(cls):
+        if cls._pending_window is not None:
+            recategorize(extra_ranges=[cls._pending_window])
+            cls._pending_window = None
+
+
+def _rebuild_ranges(
+    db: Database, ranges_to_rebuild: List[Tuple[datetime, datetime]]
+) -> List[Tuple[datetime, datetime]]:
+    """
+    Merges [start, end) ranges that need rebuilding, widened until no stored merged row crosses a range boundary, so
+    rebuilding a range never drops the part of a row that ran past it.
+    """
+    ranges: List[List[datetime]] = []
+    for range_start, range_end in sorted(ranges_to_rebuild):
+        if ranges and ranges[-1][1] >= range_start:
+            ranges[-1][1] = max(ranges[-1][1], range_end)
+        else:
+            ranges.append([range_start, range_end])
+
+    for r in ranges:
+        while True:
+            db.cursor.execute(
+                f"SELECT timestamp, duration FROM {ComputerUseSource.id} WHERE timestamp >= ? AND timestamp < ?",
+                (r[0] - td1d, r[1]),
+            )
+            rows = [(ts, ts + timedelta(seconds=duration)) for ts, duration in db.cursor.fetchall()]
+            start = min([r[0]] + [ts for ts, end in rows if ts < r[0] < end])
+            end = max([r[1]] + [end for ts, end in rows])
+            if (start, end) == (r[0], r[1]):
+                break
+            r[0], r[1] = start, end
+
+    merged_ranges: List[List[datetime]] = []
+    for start, end in ranges:
+        if merged_ranges and merged_ranges[-1][1] >= start:
+            merged_ranges[-1][1] = max(merged_ranges[-1][1], end)
+        else:
+            merged_ranges.append([start, end])
+    return [(start, end) for start, end in merged_ranges]
+
+
+def recategorize(
+    store_path: str = "./store.db",
+    extra_ranges: Optional[List[Tuple[datetime, datetime]]] = None,
+):
+    """
+    Re-categorizes stored raw events with the current CATEGORY_REGEXES, then rebuilds the merged rows (and their
+    heatmap days) only around the days containing an event whose category changed, plus `extra_ranges` (UTC).
+    No ActivityWatch queries are made.
+
+    The raw store's new categories are only committed after the main store, so if rebuilding fails the next run
+    sees the same changed pairs and tries again.
+    """
+    start = tm.perf_counter()
+    with Database(RAW_DB_PATH) as raw_db:
+        store = RawEventStore(raw_db)
+        changed_pairs = store.recategorize_pairs(Classifier())
+        day_starts = {_day_start(ts) for ts in store.timestamps_of_pairs(changed_pairs)}
+        to_rebuild = [(day, day + td1d) for day in day_starts] + (extra_ranges or [])
+
+        with Database(store_path) as db:
+            ranges = _rebuild_ranges(db, to_rebuild)
+            col_names = [s.split(" ")[0] for s in ComputerUseSource.schema]
+            days = set()
+            for range_start, range_end in ranges:
+                last = range_end - timedelta(microseconds=1)
+                rows = [
+                    asdict(je)
+                    for je in merge_events(store.categorized_events(range_start, last))
+                ]
+                db.delete_rows_in_time_range(ComputerUseSource.id, range_start, last)
+                db.insert(ComputerUseSource.id, columns=col_names, rows=rows)
+
+                day = heatmap_day(range_start)
+                while day <= heatmap_day(last):
+                    days.add(day)
+                    day += td1d
+            refresh_heatmap_days(db, ComputerUseSource, days)
+
+        store.set_meta("regexes", regexes_fingerprint())
+
+    print(
+        f"[COMPUTER_USE] {len(changed_pairs)} (app, title) pairs changed category, "
+        f"rebuilt {len(days)} days in {tm.perf_counter() - start:.2f}s"
+    )
+
+
+def backfill(start: Optional[datetime] = None, chunk_days: int = 30):
+    """
+    Loads raw events from ActivityWatch into the raw store, from `start` (default: the same start as a first fetch)
+    until now, a chunk of days per query. Merged rows aren't touched, and events already stored are skipped, so it's
+    safe to re-run or interrupt.
+
+    New (app, title) pairs get their category from the current CATEGORY_REGEXES. Merged rows from before the
+    backfill keep the categories they were fetched with until a recategorize rebuilds their days.
+    """
+    hostname = socket.gethostname()
+    if start is None:
+        start = datetime.combine(date(2020, 7, 15), time()) + day_offset
+    chunk_start = start.astimezone()
+    now = datetime.now().astimezone()
+
+    n_events = 0
+    started = tm.perf_counter()
+    while chunk_start < now:
+        chunk_end = min(chunk_start + timedelta(days=chunk_days), now)
+        raw_events = query([[chunk_start, chunk_end]], hostname)[0]["events"]
+        with Database(RAW_DB_PATH) as raw_db:
+            store = RawEventStore(raw_db)
+            store.insert_events(raw_events, Classifier())
+            if store.get_meta("regexes") is None:
+                store.set_meta("regexes", regexes_fingerprint())
+        n_events += len(raw_events)
+        print(f"[COMPUTER_USE] backfilled {chunk_start.date()} to {chunk_end.date()}: {len(raw_events)} events")
+        chunk_start = chunk_end
+
+    print(f"[COMPUTER_USE] backfilled {n_events} events in {tm.perf_counter() - started:.1f}s")
+
+
+if __name__ == "__main__":
+    import sys
 
-        return [asdict(je) for je in joined_events]
+    if "--backfill" in sys.argv:
+        backfill()
+    if "--recategorize" in sys.argv:
+        recategorize()
@@ -32,6 +32,7 @@ class HevySource(Source):
         "description TEXT",
         "volume_lb FLOAT",
     ]
+    heatmap_kind = "bitmap"
 
     @classmethod
     def fetch(cls, last_queried: Optional[datetime]) -> List[Dict]:
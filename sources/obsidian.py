@@ -4,4 +4,365 @@ this will probably be a collection of fetchers on top of the same underlying sou
 will write a simple agent abstraction that uses structured outputs for a given schema, and some other robustness stuff
 
 - sleep, activities, people, books/reading, food, todos/goals, etc.
+
+Each fetcher is an ObsidianSource subclass with an Extractor. Scanning the vault is incremental:
+- a note is only re-read when its mtime/size changed, and only re-parsed when its content hash changed
+- extractor outputs are cached by (note hash, extractor name, extractor version), so parsing costs (LLM calls
+  included) are paid once per note version. Bump an extractor's version to invalidate its cache: the next fetch
+  re-extracts every note, and the new rows replace the old version's.
+- notes that do need parsing are handed to a process pool
+
+The cache lives in its own sqlite file so it doesn't contend with the main store while fetch_all holds it open.
+Which note versions have been emitted is only saved in on_commit, after fetch_all commits their rows.
+
+`python -m sources.obsidian` runs a stub fetcher against a synthetic vault.
 """
+
+from abc import ABC, abstractmethod
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import json
+import os
+import re
+from datetime import date, datetime, time
+from typing import Dict, List, Optional, Tuple
+
+from database import Database
+from fetch import Source
+
+VAULT_PATH = os.path.expanduser(os.environ.get("OBSIDIAN_VAULT", "~/obsidian"))
+CACHE_PATH = "./obsidian_cache.db"
+DAILY_NOTE_FORMAT = "%Y-%m-%d"
+
+# below this many notes to parse, the process pool startup costs more than it saves
+MIN_NOTES_FOR_POOL = 8
+
+
+class Extractor(ABC):
+    """
+    Pulls structured rows out of a single daily note. Outputs are cached by the note's content, so they should
+    only depend on the text. Outputs must be json serializable, and instances must be picklable since they're
+    shipped to worker processes.
+    """
+
+    name: str
+    version: int = 1
+
+    @abstractmethod
+    def extract(self, text: str) -> List[Dict]:
+        pass
+
+
+class WordCountExtractor(Extractor):
+    name = "word_count"
+    version = 1
+
+    def extract(self, text: str) -> List[Dict]:
+        return [
+            {
+                "words": len(text.split()),
+                "todos_open": len(re.findall(r"^\s*[-*] \[ \]", text, re.MULTILINE)),
+                "todos_done": len(re.findall(r"^\s*[-*] \[[xX]\]", text, re.MULTILINE)),
+            }
+        ]
+
+
+def _create_cache_tables(db: Database):
+    db.cursor.execute("""CREATE TABLE IF NOT EXISTS notes (
+source TEXT,
+path TEXT,
+mtime_ns INTEGER,
+size INTEGER,
+hash TEXT,
+PRIMARY KEY (source, path)
+)""")
+    db.cursor.execute("""CREATE TABLE IF NOT EXISTS extractions (
+hash TEXT,
+extractor TEXT,
+version INTEGER,
+output TEXT,
+PRIMARY KEY (hash, extractor, version)
+)""")
+    # which extractor produced the rows a source has emitted so far
+    db.cursor.execute("""CREATE TABLE IF NOT EXISTS extractors (
+source TEXT PRIMARY KEY,
+extractor TEXT,
+version INTEGER
+)""")
+
+
+def _note_date(fname: str) -> Optional[date]:
+    if not fname.endswith(".md"):
+        return None
+    try:
+        return datetime.strptime(fname[:-3], DAILY_NOTE_FORMAT).date()
+    except ValueError:
+        return None
+
+
+def scan_vault(vault_path: str) -> List[Tuple[str, date, os.stat_result]]:
+    "Returns (path, note date, stat) for every daily note in the vault"
+    notes = []
+    for dirpath, dirnames, fnames in os.walk(vault_path):
+        dirnames[:] = [d for d in dirnames if not d.startswith(".")]  # skip .obsidian, .trash
+        for fname in fnames:
+            note_date = _note_date(fname)
+            if note_date is not None:
+                path = os.path.join(dirpath, fname)
+                notes.append((path, note_date, os.stat(path)))
+    return notes
+
+
+def hash_file(path: str) -> str:
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def _run_extractor(extractor: Extractor, path: str) -> List[Dict]:
+    with open(path, "rt", encoding="utf-8") as f:
+        text = f.read()
+    return extractor.extract(text)
+
+
+class ObsidianSource(Source):
+    """
+    Base class for fetchers over the daily notes. Subclasses set id, schema and extractor; the extractor
+    returns rows for every schema column except timestamp, which is the note's date.
+    """
+
+    extractor: Extractor
+    vault_path: str = VAULT_PATH
+    cache_path: str = CACHE_PATH
+    max_workers: Optional[int] = None
+
+    # edited notes re-emit their day's rows, which replace the old ones. deleted notes clear their day
+    replace_existing = True
+
+    # what fetch saw, saved by on_commit once fetch_all has committed the rows
+    _pending_notes: List[Tuple[str, int, int, str]] = []
+    _pending_deleted: List[str] = []
+    _deleted_timestamps: List[datetime] = []
+
+    @classmethod
+    def fetch(cls, last_queried: Optional[datetime]) -> List[Dict]:
+        cls._pending_notes, cls._pending_deleted, cls._deleted_timestamps = [], [], []
+        if not os.path.isdir(cls.vault_path):
+            print(f"[OBSIDIAN] vault not found at {cls.vault_path}, skipping {cls.id}")
+            return []
+
+        notes = scan_vault(cls.vault_path)
+        extractor = cls.extractor
+
+        with Database(cls.cache_path) as cache:
+            _create_cache_tables(cache)
+
+            cache.cursor.execute(
+                "SELECT path, mtime_ns, size, hash FROM notes WHERE source = ?",
+                (cls.id,),
+            )
+            known = {row["path"]: row for row in cache.cursor.fetchall()}
+
+            # a new extractor (or version) means every note's rows are stale, same as a first fetch
+            cache.cursor.execute(
+                "SELECT extractor, version FROM extractors WHERE source = ?", (cls.id,)
+            )
+            emitted_by = cache.cursor.fetchone()
+            refetch_all = last_queried is None or emitted_by is None or (
+                emitted_by["extractor"],
+                emitted_by["version"],
+            ) != (extractor.name, extractor.version)
+
+            # 1) find notes whose content changed since this source last saw them
+            changed: Dict[str, Tuple[date, str]] = {}
+            hashes: Dict[str, str] = {}
+            for path, note_date, stat in notes:
+                prev = known.get(path)
+                if (
+                    prev is not None
+                    and prev["mtime_ns"] == stat.st_mtime_ns
+                    and prev["size"] == stat.st_size
+                ):
+                    hashes[path] = prev["hash"]
+                    if refetch_all:
+                        changed[path] = (note_date, prev["hash"])
+                    continue
+
+                note_hash = hash_file(path)
+                hashes[path] = note_hash
+                if refetch_all or prev is None or prev["hash"] != note_hash:
+                    changed[path] = (note_date, note_hash)
+                cls._pending_notes.append(
+                    (path, stat.st_mtime_ns, stat.st_size, note_hash)
+                )
+
+            # deleted notes clear their day. if another note has the same date, re-emit it so its rows survive
+            scanned = {path: note_date for path, note_date, _ in notes}
+            cls._pending_deleted = [path for path in known if path not in scanned]
+            deleted_dates = {
+                _note_date(os.path.basename(path)) for path in cls._pending_deleted
+            }
+            cls._deleted_timestamps = [datetime.combine(d, time()) for d in deleted_dates]
+            for path, note_date in scanned.items():
+                if note_date in deleted_dates and path not in changed:
+                    changed[path] = (note_date, hashes[path])
+
+            # 2) reuse cached outputs, parse the rest. the extraction cache only depends on note content, so it's
+            # safe to save right away
+            outputs: Dict[str, List[Dict]] = {}
+            to_parse: Dict[str, str] = {}  # hash -> path, notes with identical content are parsed once
+            for path, (note_date, note_hash) in changed.items():
+                cache.cursor.execute(
+                    "SELECT output FROM extractions WHERE hash = ? AND extractor = ? AND version = ?",
+                    (note_hash, extractor.name, extractor.version),
+                )
+                cached = cache.cursor.fetchone()
+                if cached is not None:
+                    outputs[note_hash] = json.loads(cached["output"])
+                else:
+                    to_parse[note_hash] = path
+
+            parsed = cls._parse_notes(list(to_parse.values()))
+            for note_hash, output in zip(to_parse.keys(), parsed):
+                outputs[note_hash] = output
+                cache.cursor.execute(
+                    "INSERT OR REPLACE INTO extractions (hash, extractor, version, output) VALUES (?, ?, ?, ?)",
+                    (note_hash, extractor.name, extractor.version, json.dumps(output)),
+                )
+
+        print(
+            f"[OBSIDIAN] {cls.id}: {len(notes)} notes, {len(changed)} changed, "
+            f"{len(cls._pending_deleted)} deleted, {len(to_parse)} parsed"
+        )
+
+        rows = []
+        for path, (note_date, note_hash) in changed.items():
+            timestamp = datetime.combine(note_date, time())
+            rows.extend({"timestamp": timestamp, **row} for row in outputs[note_hash])
+        return rows
+
+    @classmethod
+    def replaced_timestamps(cls, rows: List[Dict]) -> List[datetime]:
+        return super().replaced_timestamps(rows) + cls._deleted_timestamps
+
+    @classmethod
+    def on_commit(cls):
+        with Database(cls.cache_path) as cache:
+            _create_cache_tables(cache)
+            cache.cursor.executemany(
+                "INSERT OR REPLACE INTO notes (source, path, mtime_ns, size, hash) VALUES (?, ?, ?, ?, ?)",
+                [(cls.id, *note) for note in cls._pending_notes],
+            )
+            cache.cursor.executemany(
+                "DELETE FROM notes WHERE source = ? AND path = ?",
+                [(cls.id, path) for path in cls._pending_deleted],
+            )
+            cache.cursor.execute(
+                "INSERT OR REPLACE INTO extractors (source, extractor, version) VALUES (?, ?, ?)",
+                (cls.id, cls.extractor.name, cls.extractor.version),
+            )
+        cls._pending_notes, cls._pending_deleted, cls._deleted_timestamps = [], [], []
+
+    @classmethod
+    def _parse_notes(cls, paths: List[str]) -> List[List[Dict]]:
+        if len(paths) < MIN_NOTES_FOR_POOL:
+            return [_run_extractor(cls.extractor, path) for path in paths]
+
+        with ProcessPoolExecutor(max_workers=cls.max_workers) as pool:
+            return list(
+                pool.map(
+                    _run_extractor,
+                    [cls.extractor] * len(paths),
+                    paths,
+                    chunksize=16,
+                )
+            )
+
+
+class ObsidianWordCountSource(ObsidianSource):
+    id = "obsidian_word_count"
+    schema = [
+        "timestamp timestamp",
+        "words INTEGER",
+        "todos_open INTEGER",
+        "todos_done INTEGER",
+    ]
+    extractor = WordCountExtractor()
+
+
+ObsidianWordCountSource.register()
+
+
+class _LengthExtractor(Extractor):
+    "stub extractor for check_synthetic_vault"
+
+    name = "length"
+    version = 1
+
+    def extract(self, text: str) -> List[Dict]:
+        return [{"length": len(text)}]
+
+
+def check_synthetic_vault(n_notes: int = 20):
+    """
+    Runs a stub fetcher against a throwaway vault: first fetch, no-op refetch, an edit (including a fetch_all
+    that never commits), a deletion, and an extractor version bump.
+    """
+    import tempfile
+    from datetime import timedelta
+
+    with tempfile.TemporaryDirectory() as tmp:
+        vault = os.path.join(tmp, "vault")
+        os.makedirs(os.path.join(vault, "daily"))
+        os.makedirs(os.path.join(vault, ".obsidian"))
+        for i in range(n_notes):
+            note_date = date(2025, 1, 1) + timedelta(days=i)
+            with open(os.path.join(vault, "daily", f"{note_date}.md"), "wt") as f:
+                f.write(f"- [ ] todo\nnote {i}\n")
+        with open(os.path.join(vault, "not a daily note.md"), "wt") as f:
+            f.write("ignored\n")
+
+        class StubSource(ObsidianSource):
+            id = "obsidian_stub"
+            schema = ["timestamp timestamp", "length INTEGER"]
+            extractor = _LengthExtractor()
+            vault_path = vault
+            cache_path = os.path.join(tmp, "cache.db")
+
+        rows = StubSource.fetch(None)
+        assert len(rows) == n_notes, rows
+        StubSource.on_commit()
+        assert StubSource.fetch(datetime.now()) == []
+        StubSource.on_commit()
+
+        edited = os.path.join(vault, "daily", "2025-01-02.md")
+        with open(edited, "at") as f:
+            f.write("more\n")
+        rows = StubSource.fetch(datetime.now())
+        assert [r["timestamp"] for r in rows] == [datetime(2025, 1, 2)], rows
+        # fetch_all rolled back, so on_commit never ran: the edit must come back
+        assert StubSource.fetch(datetime.now()) == rows
+        StubSource.on_commit()
+        assert StubSource.fetch(datetime.now()) == []
+
+        os.remove(os.path.join(vault, "daily", "2025-01-03.md"))
+        rows = StubSource.fetch(datetime.now())
+        assert rows == [] and StubSource.replaced_timestamps(rows) == [
+            datetime(2025, 1, 3)
+        ]
+        StubSource.on_commit()
+        assert StubSource.fetch(datetime.now()) == []
+        assert StubSource.replaced_timestamps([]) == []
+
+        StubSource.extractor = _LengthExtractor()
+        StubSource.extractor.version = 2
+        rows = StubSource.fetch(datetime.now())
+        assert len(rows) == n_notes - 1, rows
+        StubSource.on_commit()
+        assert StubSource.fetch(datetime.now()) == []
+
+    print("[OBSIDIAN] synthetic vault checks passed")
+
+
+if __name__ == "__main__":
+    # python -m sources.obsidian
+    check_synthetic_vault()
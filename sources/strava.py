@@ -1,12 +1,340 @@
 """
 strava source
+
+Imports a local Strava bulk export (Settings > My Account > Download or Delete Your Account), either the .zip
+or the extracted folder. Activity files (GPX/TCX/FIT, possibly gzipped) are parsed in a process pool, with
+the xml formats streamed via iterparse so big files never sit fully in memory. Names and descriptions come from
+activities.csv when it's there.
+
+Activity files are tracked by name in their own sqlite file (saved in on_commit, after fetch_all commits the rows),
+so each fetch only parses files that haven't been imported yet, whatever their dates. Files that fail to parse or
+have no points are recorded as failed, and only retried once their size or mtime changes.
+
+Per-second streams (time/lat/lon/heart rate) are optionally stored in the `streams` column as a compressed blob:
+each stream is delta-encoded as int32 (time in seconds from start, lat/lon in 1e-7 degrees, hr in bpm), with
+longitude deltas wrapped so crossing the antimeridian is a small step, plus a per-point mask of which values are
+present (missing ones repeat the previous value). The whole thing is zlib'd. Use decode_streams to get NumPy
+arrays back.
+
+FIT files need fitparse. Without it they're skipped (and not recorded), so they import once it's installed.
 """
 
-from typing import Dict, List, Optional
-from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+import csv
+import gzip
+import importlib.util
+import io
+import math
+import os
+import struct
+import sys
+import time
+import zipfile
+import zlib
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterator, List, Optional, Tuple
+import xml.etree.ElementTree as ET
+
+import numpy as np
 
+from database import Database
 from fetch import Source
 
+ARCHIVE_PATH = os.path.expanduser(os.environ.get("STRAVA_ARCHIVE", "~/strava_export"))
+IMPORTED_PATH = "./strava_imported.db"
+STORE_STREAMS = True
+
+METERS_PER_MILE = 1609.344
+LATLON_SCALE = 1e7
+FIT_SEMICIRCLES_TO_DEGREES = 180 / 2**31
+STREAM_NAMES = ("time", "lat", "lon", "hr")
+STREAMS_VERSION = 2
+LON_HALF_TURN = 180 * 10**7
+HAS_POSITION, HAS_HR = 1, 2
+ACTIVITY_EXTENSIONS = (".gpx", ".tcx", ".fit")
+
+# status of a file in the imported table
+IMPORTED, FAILED = "imported", "failed"
+
+# Point = (datetime, lat, lon, hr), lat/lon/hr may be None
+Point = Tuple[datetime, Optional[float], Optional[float], Optional[int]]
+
+
+def _wrap_lon(x: np.ndarray) -> np.ndarray:
+    "wraps longitudes (or their deltas), in 1e-7 degrees, into [-180, 180) degrees"
+    return (x + LON_HALF_TURN) % (2 * LON_HALF_TURN) - LON_HALF_TURN
+
+
+def encode_streams(points: List[Point]) -> bytes:
+    "Delta-encodes and compresses per-second streams. See decode_streams"
+    start = points[0][0]
+    n = len(points)
+    columns = np.zeros((len(STREAM_NAMES), n), dtype=np.int64)
+    mask = np.zeros(n, dtype=np.uint8)
+    lat_e7 = lon_e7 = hr = 0
+    for i, (ts, lat, lon, point_hr) in enumerate(points):
+        # missing values repeat the previous one, so they cost a zero delta
+        if lat is not None and lon is not None:
+            lat_e7, lon_e7 = round(lat * LATLON_SCALE), round(lon * LATLON_SCALE)
+            mask[i] |= HAS_POSITION
+        if point_hr is not None:
+            hr = point_hr
+            mask[i] |= HAS_HR
+        columns[:, i] = (round((ts - start).total_seconds()), lat_e7, lon_e7, hr)
+
+    deltas = np.diff(columns, axis=1, prepend=0)
+    deltas[2] = _wrap_lon(deltas[2])
+    if np.abs(deltas).max(initial=0) > np.iinfo(np.int32).max:
+        raise ValueError("stream delta doesn't fit in int32")
+
+    return zlib.compress(
+        struct.pack("<BI", STREAMS_VERSION, n)
+        + deltas.astype("<i4").tobytes()
+        + mask.tobytes(),
+        6,
+    )
+
+
+def decode_streams(blob: bytes) -> Dict[str, np.ndarray]:
+    """
+    Decodes a blob from encode_streams.
+
+    :return: {"time": int seconds from start, "lat"/"lon": float degrees (NaN if missing), "hr": int bpm (0 if
+        missing), "has_position"/"has_hr": bool masks}
+    """
+    raw = zlib.decompress(blob)
+    version, n = struct.unpack_from("<BI", raw)
+    if version != STREAMS_VERSION:
+        raise ValueError(f"unknown streams version {version}")
+
+    offset = struct.calcsize("<BI")
+    deltas = np.frombuffer(
+        raw, dtype="<i4", count=len(STREAM_NAMES) * n, offset=offset
+    ).reshape(len(STREAM_NAMES), n)
+    mask = np.frombuffer(raw, dtype=np.uint8, count=n, offset=offset + deltas.nbytes)
+    columns = np.cumsum(deltas, axis=1, dtype=np.int64)
+
+    has_position = (mask & HAS_POSITION) != 0
+    has_hr = (mask & HAS_HR) != 0
+    return {
+        "time": columns[0],
+        "lat": np.where(has_position, columns[1] / LATLON_SCALE, np.nan),
+        "lon": np.where(has_position, _wrap_lon(columns[2]) / LATLON_SCALE, np.nan),
+        "hr": np.where(has_hr, columns[3], 0),
+        "has_position": has_position,
+        "has_hr": has_hr,
+    }
+
+
+def _haversine_m(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    p1, p2 = math.radians(lat1), math.radians(lat2)
+    dp, dl = p2 - p1, math.radians(lon2 - lon1)
+    a = math.sin(dp / 2) ** 2 + math.cos(p1) * math.cos(p2) * math.sin(dl / 2) ** 2
+    return 2 * 6371008.8 * math.asin(math.sqrt(a))
+
+
+def _parse_time(s: str) -> datetime:
+    return datetime.fromisoformat(s.strip().replace("Z", "+00:00"))
+
+
+def _local(dt: datetime) -> datetime:
+    "naive local time, to match the other sources"
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt.astimezone().replace(tzinfo=None)
+
+
+def _local_name(tag: str) -> str:
+    return tag.rsplit("}", 1)[-1]
+
+
+def _child_text(elem: ET.Element, *names: str) -> Optional[str]:
+    "text of the first descendant matching the path of local names, ignoring namespaces"
+    for name in names:
+        elem = next((c for c in elem if _local_name(c.tag) == name), None)
+        if elem is None:
+            return None
+    return elem.text
+
+
+def _parse_gpx(f) -> Tuple[Dict, List[Point]]:
+    meta: Dict = {}
+    points: List[Point] = []
+    for _, elem in ET.iterparse(f, events=("end",)):
+        tag = _local_name(elem.tag)
+        if tag == "trkpt":
+            ts = _child_text(elem, "time")
+            if ts is not None:
+                hr = next(
+                    (c.text for c in elem.iter() if _local_name(c.tag) == "hr"), None
+                )
+                points.append(
+                    (
+                        _parse_time(ts),
+                        float(elem.get("lat")),
+                        float(elem.get("lon")),
+                        int(hr) if hr else None,
+                    )
+                )
+            elem.clear()
+        elif tag == "name" and "name" not in meta:
+            meta["name"] = elem.text
+        elif tag == "type" and "type" not in meta:
+            meta["type"] = elem.text
+
+    distance = 0.0
+    for a, b in zip(points, points[1:]):
+        distance += _haversine_m(a[1], a[2], b[1], b[2])
+    meta["distance_m"] = distance
+    return meta, points
+
+
+def _parse_tcx(f) -> Tuple[Dict, List[Point]]:
+    meta: Dict = {"distance_m": 0.0}
+    points: List[Point] = []
+    for _, elem in ET.iterparse(f, events=("end",)):
+        tag = _local_name(elem.tag)
+        if tag == "Trackpoint":
+            ts = _child_text(elem, "Time")
+            if ts is not None:
+                lat = _child_text(elem, "Position", "LatitudeDegrees")
+                lon = _child_text(elem, "Position", "LongitudeDegrees")
+                hr = _child_text(elem, "HeartRateBpm", "Value")
+                points.append(
+                    (
+                        _parse_time(ts),
+                        float(lat) if lat else None,
+                        float(lon) if lon else None,
+                        int(hr) if hr else None,
+                    )
+                )
+            elem.clear()
+        elif tag == "Lap":
+            distance = _child_text(elem, "DistanceMeters")
+            if distance:
+                meta["distance_m"] += float(distance)
+            elem.clear()
+        elif tag == "Activity":
+            meta["type"] = elem.get("Sport")
+    return meta, points
+
+
+def _parse_fit(f) -> Tuple[Dict, List[Point]]:
+    import fitparse
+
+    meta: Dict = {}
+    points: List[Point] = []
+    for message in fitparse.FitFile(f).get_messages(["record", "session"]):
+        values = message.get_values()
+        if message.name == "session":
+            meta["distance_m"] = values.get("total_distance") or 0.0
+            meta["type"] = values.get("sport")
+        elif values.get("timestamp") is not None:
+            lat, lon = values.get("position_lat"), values.get("position_long")
+            points.append(
+                (
+                    values["timestamp"],
+                    lat * FIT_SEMICIRCLES_TO_DEGREES if lat is not None else None,
+                    lon * FIT_SEMICIRCLES_TO_DEGREES if lon is not None else None,
+                    values.get("heart_rate"),
+                )
+            )
+    return meta, points
+
+
+PARSERS = {".gpx": _parse_gpx, ".tcx": _parse_tcx, ".fit": _parse_fit}
+
+_open_archives: Dict[str, zipfile.ZipFile] = {}  # per worker process
+
+
+def _open_activity_file(archive_path: str, name: str):
+    if os.path.isdir(archive_path):
+        path = os.path.join(archive_path, name)
+        return gzip.open(path, "rb") if name.endswith(".gz") else open(path, "rb")
+
+    if archive_path not in _open_archives:
+        _open_archives[archive_path] = zipfile.ZipFile(archive_path)
+    f = _open_archives[archive_path].open(name)
+    return gzip.GzipFile(fileobj=f) if name.endswith(".gz") else f
+
+
+def _activity_extension(name: str) -> str:
+    return os.path.splitext(name[:-3] if name.endswith(".gz") else name)[1].lower()
+
+
+def parse_activity_file(
+    archive_path: str, name: str, store_streams: bool
+) -> Optional[Dict]:
+    "Parses one activity file into a summary row (without name/description from activities.csv)"
+    ext = _activity_extension(name)
+    try:
+        with _open_activity_file(archive_path, name) as f:
+            meta, points = PARSERS[ext](f)
+    except Exception as e:
+        print(f"[STRAVA] failed to parse {name}: {e}")
+        return None
+
+    if len(points) == 0:
+        return None
+
+    start = points[0][0]
+    if start.tzinfo is None:
+        points = [(ts.replace(tzinfo=timezone.utc), *rest) for ts, *rest in points]
+        start = points[0][0]
+
+    return {
+        "timestamp": _local(start),
+        "duration": points[-1][0] - start,
+        "name": meta.get("name") or meta.get("type"),
+        "description": None,
+        "distance_mi": meta.get("distance_m", 0.0) / METERS_PER_MILE,
+        "streams": encode_streams(points) if store_streams else None,
+    }
+
+
+def list_activity_files(archive_path: str) -> Dict[str, Tuple[int, int]]:
+    "Maps activity file names relative to the archive root to their (size, mtime), sorted by name"
+    files: Dict[str, Tuple[int, int]] = {}
+    if zipfile.is_zipfile(archive_path):
+        with zipfile.ZipFile(archive_path) as zf:
+            for info in zf.infolist():
+                files[info.filename] = (
+                    info.file_size,
+                    int(datetime(*info.date_time).timestamp()),
+                )
+    else:
+        for dirpath, _, fnames in os.walk(archive_path):
+            for fname in fnames:
+                path = os.path.join(dirpath, fname)
+                stat = os.stat(path)
+                files[os.path.relpath(path, archive_path)] = (stat.st_size, stat.st_mtime_ns)
+    return {
+        name: files[name]
+        for name in sorted(files)
+        if name.lower().removesuffix(".gz").endswith(ACTIVITY_EXTENSIONS)
+    }
+
+
+def read_activities_csv(archive_path: str) -> Dict[str, Dict]:
+    "Maps activity file name to its activities.csv row, if the export has one"
+    if zipfile.is_zipfile(archive_path):
+        with zipfile.ZipFile(archive_path) as zf:
+            if "activities.csv" not in zf.namelist():
+                return {}
+            text = zf.read("activities.csv").decode("utf-8-sig")
+    else:
+        csv_path = os.path.join(archive_path, "activities.csv")
+        if not os.path.exists(csv_path):
+            return {}
+        with open(csv_path, "rt", encoding="utf-8-sig") as f:
+            text = f.read()
+
+    return {
+        row["Filename"]: row
+        for row in csv.DictReader(io.StringIO(text))
+        if row.get("Filename")
+    }
+
 
 class StravaSource(Source):
     id = "strava"
@@ -16,11 +344,188 @@ class StravaSource(Source):
         "name TEXT",
         "description TEXT",
         "distance_mi FLOAT",
+        "streams BLOB",
     ]
+    heatmap_kind = "seconds"
+
+    archive_path: str = ARCHIVE_PATH
+    imported_path: str = IMPORTED_PATH
+    store_streams: bool = STORE_STREAMS
+    max_workers: Optional[int] = None
+
+    # (name, status, size, mtime) of every file fetch parsed, saved by on_commit
+    _pending_imported: List[Tuple[str, str, int, int]] = []
 
     @classmethod
     def fetch(cls, last_queried: Optional[datetime]) -> List[Dict]:
-        pass
+        """
+        Import every activity file in the archive that hasn't been imported before, or that failed and has changed
+        since
+        """
+        cls._pending_imported = []
+        if not os.path.exists(cls.archive_path):
+            print(f"[STRAVA] no export found at {cls.archive_path}, skipping")
+            return []
+
+        known = cls._known_files()
+        files = list_activity_files(cls.archive_path)
+        names = [
+            name
+            for name, stat in files.items()
+            if name not in known or (known[name][0] == FAILED and known[name][1:] != stat)
+        ]
+        if importlib.util.find_spec("fitparse") is None:
+            fit_names = {n for n in names if _activity_extension(n) == ".fit"}
+            if fit_names:
+                print(f"[STRAVA] skipping {len(fit_names)} FIT files, install fitparse to import them")
+                names = [n for n in names if n not in fit_names]
+        if len(names) == 0:
+            return []
+
+        csv_rows = read_activities_csv(cls.archive_path)
+        rows = []
+        for name, row in cls._parse_all(names):
+            cls._pending_imported.append((name, FAILED if row is None else IMPORTED, *files[name]))
+            if row is None:
+                continue
+            if name in csv_rows:
+                row["name"] = csv_rows[name].get("Activity Name") or row["name"]
+                row["description"] = csv_rows[name].get("Activity Description") or None
+            rows.append(row)
+        return rows
+
+    @classmethod
+    def on_commit(cls):
+        with Database(cls.imported_path) as db:
+            cls._create_imported_table(db)
+            db.cursor.executemany(
+                "INSERT OR REPLACE INTO imported (name, status, size, mtime) VALUES (?, ?, ?, ?)",
+                cls._pending_imported,
+            )
+        cls._pending_imported = []
+
+    @classmethod
+    def _create_imported_table(cls, db: Database):
+        db.cursor.execute("""CREATE TABLE IF NOT EXISTS imported (
+name TEXT PRIMARY KEY,
+status TEXT,
+size INTEGER,
+mtime INTEGER
+)""")
+        db.cursor.execute("PRAGMA table_info(imported)")
+        if "status" not in {row["name"] for row in db.cursor.fetchall()}:
+            # tables from before failures were tracked only list imported names
+            db.cursor.execute(f"ALTER TABLE imported ADD COLUMN status TEXT DEFAULT '{IMPORTED}'")
+            db.cursor.execute("ALTER TABLE imported ADD COLUMN size INTEGER")
+            db.cursor.execute("ALTER TABLE imported ADD COLUMN mtime INTEGER")
+
+    @classmethod
+    def _known_files(cls) -> Dict[str, Tuple[str, int, int]]:
+        "(status, size, mtime) of every file a previous fetch recorded"
+        with Database(cls.imported_path) as db:
+            cls._create_imported_table(db)
+            db.cursor.execute("SELECT name, status, size, mtime FROM imported")
+            return {
+                row["name"]: (row["status"], row["size"], row["mtime"])
+                for row in db.cursor.fetchall()
+            }
+
+    @classmethod
+    def _parse_all(cls, names: List[str]) -> Iterator[Tuple[str, Optional[Dict]]]:
+        with ProcessPoolExecutor(max_workers=cls.max_workers) as pool:
+            yield from zip(
+                names,
+                pool.map(
+                    parse_activity_file,
+                    [cls.archive_path] * len(names),
+                    names,
+                    [cls.store_streams] * len(names),
+                    chunksize=16,
+                ),
+            )
+
+
+StravaSource.register()
+
+
+def _write_synthetic_archive(path: str, n_activities: int, seconds: int = 3600):
+    "Writes a folder of gzipped GPX files shaped like a Strava export, for benchmarking"
+    os.makedirs(os.path.join(path, "activities"), exist_ok=True)
+    rng = np.random.default_rng(0)
+    start = datetime(2020, 1, 1, 7, tzinfo=timezone.utc)
+    for i in range(n_activities):
+        t0 = start + timedelta(days=i)
+        lat = 41.8 + np.cumsum(rng.normal(0, 2e-5, seconds))
+        lon = -71.4 + np.cumsum(rng.normal(0, 2e-5, seconds))
+        hr = np.clip(140 + np.cumsum(rng.integers(-1, 2, seconds)), 60, 200)
+        trkpts = "".join(
+            f'<trkpt lat="{lat[s]:.7f}" lon="{lon[s]:.7f}"><time>{(t0 + timedelta(seconds=s)).isoformat()}</time>'
+            f"<extensions><gpxtpx:TrackPointExtension><gpxtpx:hr>{hr[s]}</gpxtpx:hr></gpxtpx:TrackPointExtension></extensions></trkpt>"
+            for s in range(seconds)
+        )
+        gpx = (
+            '<?xml version="1.0" encoding="UTF-8"?><gpx version="1.1" xmlns="http://www.topografix.com/GPX/1/1" '
+            'xmlns:gpxtpx="http://www.garmin.com/xmlschemas/TrackPointExtension/v1">'
+            f"<trk><name>Run {i}</name><type>running</type><trkseg>{trkpts}</trkseg></trk></gpx>"
+        )
+        with gzip.open(os.path.join(path, "activities", f"{i}.gpx.gz"), "wt") as f:
+            f.write(gpx)
+
+    # files that can't be imported, which re-fetches should skip
+    with gzip.open(os.path.join(path, "activities", "broken.gpx.gz"), "wt") as f:
+        f.write("<gpx><trk>")
+    with open(os.path.join(path, "activities", "empty.gpx"), "wt") as f:
+        f.write('<gpx xmlns="http://www.topografix.com/GPX/1/1"><trk><trkseg></trkseg></trk></gpx>')
+
+
+def benchmark(archive_path: str):
+    "Imports an archive into a throwaway store, reporting import time and on-disk size"
+    import tempfile
+
+    files = list_activity_files(archive_path)
+    if os.path.isdir(archive_path):
+        archive_bytes = sum(size for size, _ in files.values())
+    else:
+        archive_bytes = os.path.getsize(archive_path)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        StravaSource.archive_path = archive_path
+        StravaSource.imported_path = os.path.join(tmp, "imported.db")
+        store_path = os.path.join(tmp, "store.db")
+
+        start = time.perf_counter()
+        rows = StravaSource.fetch(None)
+        with Database(store_path) as db:
+            db.create_table(StravaSource.id, StravaSource.schema)
+            col_names = [s.split(" ")[0] for s in StravaSource.schema]
+            db.insert(StravaSource.id, columns=col_names, rows=rows)
+        StravaSource.on_commit()
+        elapsed = time.perf_counter() - start
+
+        start = time.perf_counter()
+        assert StravaSource.fetch(None) == []
+        refetch_elapsed = time.perf_counter() - start
+
+        stream_bytes = sum(len(r["streams"]) for r in rows if r["streams"])
+        points = sum(len(decode_streams(r["streams"])["time"]) for r in rows if r["streams"])
+        print(f"imported {len(rows)} activities ({points:,} points) from {len(files)} files in {elapsed:.1f}s")
+        print(f"re-fetch with nothing new: {refetch_elapsed:.2f}s")
+        print(
+            f"archive: {archive_bytes / 1e6:.1f} MB, streams: {stream_bytes / 1e6:.1f} MB, "
+            f"sqlite store: {os.path.getsize(store_path) / 1e6:.1f} MB"
+        )
+        if points:
+            print(f"{stream_bytes / points:.2f} bytes/point (raw int32 x4 = 16 bytes/point)")
+
 
+if __name__ == "__main__":
+    # benchmark: python -m sources.strava [archive path | --synthetic N [SECONDS]]
+    import tempfile
 
-# StravaSource.register()
+    if len(sys.argv) > 2 and sys.argv[1] == "--synthetic":
+        with tempfile.TemporaryDirectory(prefix="strava_bench_") as archive:
+            seconds = int(sys.argv[3]) if len(sys.argv) > 3 else 3600
+            _write_synthetic_archive(archive, int(sys.argv[2]), seconds)
+            benchmark(archive)
+    else:
+        benchmark(sys.argv[1] if len(sys.argv) > 1 else ARCHIVE_PATH)
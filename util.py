@@ -1,4 +1,4 @@
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
 
 
 def get_start_of_week(dt: datetime = None) -> datetime:
@@ -25,3 +25,14 @@ def get_timeperiods(
         period_end = period_start + delta
         periods.append((period_start, period_end))
     return periods
+
+
+DAY_OFFSET = timedelta(hours=4)  # days start at 4am, so late nights count toward the previous day
+
+
+def get_day(dt: datetime) -> date:
+    """
+    Returns the local day a datetime belongs to, with days starting at DAY_OFFSET.
+    Naive datetimes are assumed to already be local.
+    """
+    return (dt.astimezone() - DAY_OFFSET).date()